@@ -4,18 +4,34 @@ import http.client
 import json
 import logging
 import os
+import pickle
 import platform
+import shutil
+import string
+import tempfile
+import threading
 import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import List
 
 import dotenv
+import faiss
 import openai
+import orjson
 import requests
+import tiktoken
 from celery import Celery
 from celery.result import AsyncResult
 from flask import Flask, request, send_from_directory, jsonify, Response, redirect
 from langchain import FAISS
-from langchain import VectorDBQA, Cohere, OpenAI
-from langchain.chains import LLMChain, ConversationalRetrievalChain
+from langchain import Cohere, OpenAI
+from langchain.callbacks.manager import (
+    AsyncCallbackManagerForRetrieverRun,
+    CallbackManagerForRetrieverRun,
+)
+from langchain.chains import LLMChain, ConversationalRetrievalChain, RetrievalQA
 from langchain.chains.conversational_retrieval.prompts import CONDENSE_QUESTION_PROMPT
 from langchain.chains.question_answering import load_qa_chain
 from langchain.chat_models import ChatOpenAI, AzureChatOpenAI
@@ -25,17 +41,20 @@ from langchain.embeddings import (
     CohereEmbeddings,
     HuggingFaceInstructEmbeddings,
 )
+from langchain.embeddings.base import Embeddings
 from langchain.prompts import PromptTemplate
 from langchain.prompts.chat import (
     ChatPromptTemplate,
     SystemMessagePromptTemplate,
     HumanMessagePromptTemplate,
-    AIMessagePromptTemplate,
 )
-from langchain.schema import HumanMessage, AIMessage
+from langchain.schema import BaseRetriever, Document, HumanMessage, AIMessage
 from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+from requests.adapters import HTTPAdapter
 from werkzeug.utils import secure_filename
 
+from application.core.embeddings import get_local_embeddings, is_local_embeddings
 from application.core.settings import settings
 from application.error import bad_request
 from application.worker import ingest_worker
@@ -51,16 +70,24 @@ else:
 
 
 if settings.SELF_HOSTED_MODEL:
+    import torch
     from langchain.llms import HuggingFacePipeline
     from transformers import AutoModelForCausalLM, AutoTokenizer, pipeline
 
     model_id = settings.LLM_NAME # hf model id (Arc53/docsgpt-7b-falcon, Arc53/docsgpt-14b)
+    # half precision weights, bf16 unless the gpu only supports fp16
+    if torch.cuda.is_available() and not torch.cuda.is_bf16_supported():
+        torch_dtype = torch.float16
+    else:
+        torch_dtype = torch.bfloat16
     tokenizer = AutoTokenizer.from_pretrained(model_id)
-    model = AutoModelForCausalLM.from_pretrained(model_id)
+    model = AutoModelForCausalLM.from_pretrained(model_id, torch_dtype=torch_dtype, device_map="auto", use_cache=True)
+    # some checkpoints ship with use_cache=False, which disables the kv-cache during generation
+    model.config.use_cache = True
     pipe = pipeline(
         "text-generation", model=model,
         tokenizer=tokenizer, max_new_tokens=2000,
-        device_map="auto", eos_token_id=tokenizer.eos_token_id
+        torch_dtype=torch_dtype, eos_token_id=tokenizer.eos_token_id
     )
     hf = HuggingFacePipeline(pipeline=pipe)
 
@@ -92,6 +119,15 @@ with open(os.path.join(current_dir, "prompts", "chat_combine_prompt.txt"), "r")
 with open(os.path.join(current_dir, "prompts", "chat_reduce_prompt.txt"), "r") as f:
     chat_reduce_template = f.read()
 
+# prompt templates are immutable, parse them once
+q_prompt = PromptTemplate(input_variables=["context", "question"], template=template_quest, template_format="jinja2")
+system_combine_prompt = SystemMessagePromptTemplate.from_template(chat_combine_template)
+human_question_prompt = HumanMessagePromptTemplate.from_template("{question}")
+# chat_combine_template for the streaming endpoint, with {summaries} as its only placeholder
+chat_combine_stream_template = string.Template(
+    chat_combine_template.replace("$", "$$").replace("{summaries}", "${summaries}")
+)
+
 api_key_set = settings.API_KEY is not None
 embeddings_key_set = settings.EMBEDDINGS_KEY is not None
 
@@ -108,23 +144,82 @@ vectors_collection = db["vectors"]
 conversations_collection = db["conversations"]
 
 
+def create_indexes():
+    """Create the mongo indexes used by the conversation and vectors queries (no-op if they exist)."""
+    try:
+        conversations_collection.create_index([("date", -1)], background=True)
+        vectors_collection.create_index([("user", 1), ("location", 1)], background=True)
+        vectors_collection.create_index([("location", 1)], background=True)
+    except PyMongoError as e:
+        logger.warning("could not create mongo indexes: %s", e)
+
+
+# pooled keep-alive connections for the app's own outgoing HTTP calls
+http_session = requests.Session()
+http_session.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=32))
+http_session.mount("http://", HTTPAdapter(pool_connections=16, pool_maxsize=32))
+
+# runs blocking HTTP calls concurrently with other work of the request
+http_executor = ThreadPoolExecutor(max_workers=8)
+
+
+def is_azure_configured():
+    return settings.OPENAI_API_BASE and settings.OPENAI_API_VERSION and settings.AZURE_DEPLOYMENT_NAME
+
+
+# the openai module configuration is global, set it once instead of on every request
+azure_configured = bool(is_azure_configured())
+if azure_configured:
+    openai.api_type = "azure"
+    openai.api_version = settings.OPENAI_API_VERSION
+    openai.api_base = settings.OPENAI_API_BASE
+
+
+def create_chat_llm(api_key):
+    if azure_configured:
+        logger.debug("in Azure")
+        return AzureChatOpenAI(
+            openai_api_key=api_key,
+            openai_api_base=settings.OPENAI_API_BASE,
+            openai_api_version=settings.OPENAI_API_VERSION,
+            deployment_name=settings.AZURE_DEPLOYMENT_NAME,
+        )
+    logger.debug("plain OpenAI")
+    return ChatOpenAI(openai_api_key=api_key, model_name=gpt_model)  # optional parameter: model_name="gpt-4"
+
+
+# shared chat model when the api key comes from the settings, otherwise it's built per request
+chat_llm = create_chat_llm(settings.API_KEY) if api_key_set and settings.LLM_NAME == "openai_chat" else None
+
+# upper bounds on what the conversation endpoints read from mongo
+CONVERSATIONS_LIST_LIMIT = 100
+CONVERSATION_QUERIES_LIMIT = 200
+
+
 async def async_generate(chain, question, chat_history):
     result = await chain.arun({"question": question, "chat_history": chat_history})
     return result
 
 
+# one event loop for all requests, running on a background thread
+async_loop = asyncio.new_event_loop()
+threading.Thread(target=async_loop.run_forever, name="async-chain-loop", daemon=True).start()
+
+
 def run_async_chain(chain, question, chat_history):
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
+    future = asyncio.run_coroutine_threadsafe(async_generate(chain, question, chat_history), async_loop)
     result = {}
-    try:
-        answer = loop.run_until_complete(async_generate(chain, question, chat_history))
-    finally:
-        loop.close()
-    result["answer"] = answer
+    result["answer"] = future.result()
     return result
 
 
+def parse_history(history):
+    # history is a JSON array, older clients send it as a JSON encoded string (or "" / null)
+    if isinstance(history, str):
+        history = json.loads(history) if history else []
+    return history or []
+
+
 def get_vectorstore(data):
     if "active_docs" in data:
         if data["active_docs"].split("/")[0] == "local":
@@ -142,23 +237,138 @@ def get_vectorstore(data):
     return vectorstore
 
 
-def get_docsearch(vectorstore, embeddings_key):
+# loaded embeddings clients and FAISS stores, shared between requests
+embeddings_cache = OrderedDict()
+embeddings_cache_lock = threading.Lock()
+EMBEDDINGS_CACHE_SIZE = 16
+docsearch_cache = OrderedDict()
+docsearch_cache_lock = threading.Lock()
+DOCSEARCH_CACHE_SIZE = 32
+# number of IVF lists probed per query on IVF-PQ indexes
+FAISS_NPROBE = 8
+
+
+def get_embeddings(embeddings_key):
+    """Return the embeddings client for (EMBEDDINGS_NAME, key), reusing recently used clients (LRU)."""
+    cache_key = (settings.EMBEDDINGS_NAME, embeddings_key)
+    with embeddings_cache_lock:
+        if cache_key in embeddings_cache:
+            embeddings_cache.move_to_end(cache_key)
+            return embeddings_cache[cache_key]
     if settings.EMBEDDINGS_NAME == "openai_text-embedding-ada-002":
-        if is_azure_configured():
+        if azure_configured:
             os.environ["OPENAI_API_TYPE"] = "azure"
-            openai_embeddings = OpenAIEmbeddings(model=settings.AZURE_EMBEDDINGS_DEPLOYMENT_NAME)
+            embeddings = OpenAIEmbeddings(model=settings.AZURE_EMBEDDINGS_DEPLOYMENT_NAME)
         else:
-            openai_embeddings = OpenAIEmbeddings(openai_api_key=embeddings_key)
-        docsearch = FAISS.load_local(vectorstore, openai_embeddings)
+            embeddings = OpenAIEmbeddings(openai_api_key=embeddings_key)
     elif settings.EMBEDDINGS_NAME == "huggingface_sentence-transformers/all-mpnet-base-v2":
-        docsearch = FAISS.load_local(vectorstore, HuggingFaceHubEmbeddings())
+        embeddings = HuggingFaceHubEmbeddings()
     elif settings.EMBEDDINGS_NAME == "huggingface_hkunlp/instructor-large":
-        docsearch = FAISS.load_local(vectorstore, HuggingFaceInstructEmbeddings())
+        embeddings = HuggingFaceInstructEmbeddings()
     elif settings.EMBEDDINGS_NAME == "cohere_medium":
-        docsearch = FAISS.load_local(vectorstore, CohereEmbeddings(cohere_api_key=embeddings_key))
+        embeddings = CohereEmbeddings(cohere_api_key=embeddings_key)
+    elif is_local_embeddings(settings.EMBEDDINGS_NAME):
+        embeddings = get_local_embeddings(settings.EMBEDDINGS_NAME)
+    else:
+        raise ValueError("unknown embeddings model")
+    with embeddings_cache_lock:
+        embeddings_cache[cache_key] = embeddings
+        embeddings_cache.move_to_end(cache_key)
+        while len(embeddings_cache) > EMBEDDINGS_CACHE_SIZE:
+            embeddings_cache.popitem(last=False)
+    return embeddings
+
+
+class MissingEmbeddings(Embeddings):
+    """Placeholder for shared stores, queries are embedded with the caller's client from get_embeddings."""
+
+    def embed_documents(self, texts):
+        raise RuntimeError("shared FAISS stores have no embeddings client, search them by vector")
+
+    def embed_query(self, text):
+        raise RuntimeError("shared FAISS stores have no embeddings client, search them by vector")
+
+
+def get_index_files_stamp(vectorstore):
+    # os.replace gives a new inode and in-place writes a new mtime, so this changes whenever the files do
+    stamp = []
+    for filename in ("index.faiss", "index.pkl"):
+        stat = os.stat(os.path.join(vectorstore, filename))
+        stamp.append((stat.st_ino, stat.st_mtime_ns))
+    return tuple(stamp)
+
+
+def get_docsearch(vectorstore):
+    """Load the FAISS store for a vectorstore path, reusing already loaded stores (LRU).
+
+    The store is shared by all callers, so it holds no embeddings client (and no api key).
+    Cached stores are checked against the index files on every call: other workers may
+    have replaced or deleted them.
+    """
+    cache_key = (os.path.normpath(vectorstore), settings.EMBEDDINGS_NAME)
+    try:
+        stamp = get_index_files_stamp(vectorstore)
+    except OSError:
+        invalidate_docsearch_cache(vectorstore)
+        raise
+    with docsearch_cache_lock:
+        if cache_key in docsearch_cache:
+            cached_stamp, docsearch = docsearch_cache[cache_key]
+            if cached_stamp == stamp:
+                docsearch_cache.move_to_end(cache_key)
+                return docsearch
+            del docsearch_cache[cache_key]
+    # same files as FAISS.load_local, but IVF inverted lists stay on disk and are paged in on demand
+    index = faiss.read_index(os.path.join(vectorstore, "index.faiss"), faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+    with open(os.path.join(vectorstore, "index.pkl"), "rb") as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+    docsearch = FAISS(MissingEmbeddings().embed_query, index, docstore, index_to_docstore_id)
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        ivf.nprobe = FAISS_NPROBE
+    with docsearch_cache_lock:
+        docsearch_cache[cache_key] = (stamp, docsearch)
+        docsearch_cache.move_to_end(cache_key)
+        while len(docsearch_cache) > DOCSEARCH_CACHE_SIZE:
+            docsearch_cache.popitem(last=False)
     return docsearch
 
 
+def invalidate_docsearch_cache(path):
+    """Drop cached FAISS stores loaded from path (e.g. indexes/<user>/<job>), so the next load reads the disk.
+
+    Only affects this process, other workers notice the change through the file stamps in get_docsearch.
+    """
+    path = os.path.normpath(path)
+    with docsearch_cache_lock:
+        for cache_key in list(docsearch_cache):
+            if cache_key[0] == path or cache_key[0].endswith(os.sep + path):
+                del docsearch_cache[cache_key]
+
+
+class StaticRetriever(BaseRetriever):
+    """Retriever returning documents that were already fetched for the request."""
+
+    docs: List[Document]
+
+    def _get_relevant_documents(self, query, *, run_manager: CallbackManagerForRetrieverRun):
+        return self.docs
+
+    async def _aget_relevant_documents(self, query, *, run_manager: AsyncCallbackManagerForRetrieverRun):
+        return self.docs
+
+
+@lru_cache(maxsize=1)
+def get_encoding():
+    return tiktoken.encoding_for_model(gpt_model)
+
+
+@lru_cache(maxsize=4096)
+def count_tokens(text):
+    # history is resent with every request, so the same strings get counted over and over
+    return len(get_encoding().encode(text))
+
+
 @celery.task(bind=True)
 def ingest(self, directory, formats, name_job, filename, user):
     resp = ingest_worker(self, directory, formats, name_job, filename, user)
@@ -179,56 +389,50 @@ def home():
         return 'Welcome to DocsGPT Backend!'
 
 
-def complete_stream(question, docsearch, chat_history, api_key, conversation_id):
-    openai.api_key = api_key
-    if is_azure_configured():
-        logger.debug("in Azure")
-        openai.api_type = "azure"
-        openai.api_version = settings.OPENAI_API_VERSION
-        openai.api_base = settings.OPENAI_API_BASE
-        llm = AzureChatOpenAI(
-            openai_api_key=api_key,
-            openai_api_base=settings.OPENAI_API_BASE,
-            openai_api_version=settings.OPENAI_API_VERSION,
-            deployment_name=settings.AZURE_DEPLOYMENT_NAME,
-        )
-    else:
-        logger.debug("plain OpenAI")
-        llm = ChatOpenAI(openai_api_key=api_key)
-    docs = docsearch.similarity_search(question, k=2)
-    # join all page_content together with a newline
-    docs_together = "\n".join([doc.page_content for doc in docs])
-    p_chat_combine = chat_combine_template.replace("{summaries}", docs_together)
-    messages_combine = [{"role": "system", "content": p_chat_combine}]
+def conversation_title(question):
+    # the first words of the question, instead of asking the LLM for a summary
+    return " ".join(question.split()[:3]) or "New chat"
+
+
+def complete_stream(question, docsearch, query_vector, chat_history, api_key, conversation_id):
+    docs = docsearch.similarity_search_by_vector(query_vector, k=2)
+    # one pass over the documents for the prompt, the source log and the source events
+    docs_contents = []
     source_log_docs = []
     for doc in docs:
+        docs_contents.append(doc.page_content)
         if doc.metadata:
-            data = json.dumps({"type": "source", "doc": doc.page_content, "metadata": doc.metadata})
-            source_log_docs.append({"title": doc.metadata['title'].split('/')[-1], "text": doc.page_content})
+            data = orjson.dumps({"type": "source", "doc": doc.page_content, "metadata": doc.metadata}).decode()
+            source_log_docs.append({"title": doc.metadata['title'].rsplit('/', 1)[-1], "text": doc.page_content})
         else:
-            data = json.dumps({"type": "source", "doc": doc.page_content})
+            data = orjson.dumps({"type": "source", "doc": doc.page_content}).decode()
             source_log_docs.append({"title": doc.page_content, "text": doc.page_content})
         yield f"data:{data}\n\n"
+    # join all page_content together with a newline
+    docs_together = "\n".join(docs_contents)
+    p_chat_combine = chat_combine_stream_template.substitute(summaries=docs_together)
+    messages_combine = [{"role": "system", "content": p_chat_combine}]
 
     if len(chat_history) > 1:
         tokens_current_history = 0
-        # count tokens in history
-        chat_history.reverse()
-        for i in chat_history:
+        # count tokens in history, newest first, until the budget is used up
+        for i in reversed(chat_history):
             if "prompt" in i and "response" in i:
-                tokens_batch = llm.get_num_tokens(i["prompt"]) + llm.get_num_tokens(i["response"])
-                if tokens_current_history + tokens_batch < settings.TOKENS_MAX_HISTORY:
-                    tokens_current_history += tokens_batch
-                    messages_combine.append({"role": "user", "content": i["prompt"]})
-                    messages_combine.append({"role": "system", "content": i["response"]})
+                tokens_batch = count_tokens(i["prompt"]) + count_tokens(i["response"])
+                if tokens_current_history + tokens_batch >= settings.TOKENS_MAX_HISTORY:
+                    break
+                tokens_current_history += tokens_batch
+                messages_combine.append({"role": "user", "content": i["prompt"]})
+                messages_combine.append({"role": "system", "content": i["response"]})
     messages_combine.append({"role": "user", "content": question})
     completion = openai.ChatCompletion.create(model=gpt_model, engine=settings.AZURE_DEPLOYMENT_NAME,
-                                              messages=messages_combine, stream=True, max_tokens=500, temperature=0)
+                                              messages=messages_combine, stream=True, max_tokens=500, temperature=0,
+                                              api_key=api_key)
     reponse_full = ""
     for line in completion:
         if "content" in line["choices"][0]["delta"]:
             # check if the delta contains content
-            data = json.dumps({"answer": str(line["choices"][0]["delta"]["content"])})
+            data = orjson.dumps({"answer": str(line["choices"][0]["delta"]["content"])}).decode()
             reponse_full += str(line["choices"][0]["delta"]["content"])
             yield f"data: {data}\n\n"
     # save conversation to database
@@ -240,28 +444,17 @@ def complete_stream(question, docsearch, chat_history, api_key, conversation_id)
 
     else:
         # create new conversation
-        # generate summary
-        messages_summary = [{"role": "assistant", "content": "Summarise following conversation in no more than 3 "
-                                                             "words, respond ONLY with the summary, use the same "
-                                                             "language as the system \n\nUser: " + question + "\n\n" +
-                                                             "AI: " +
-                                                             reponse_full},
-                            {"role": "user", "content": "Summarise following conversation in no more than 3 words, "
-                                                        "respond ONLY with the summary, use the same language as the "
-                                                        "system"}]
-        completion = openai.ChatCompletion.create(model='gpt-3.5-turbo', engine=settings.AZURE_DEPLOYMENT_NAME,
-                                                  messages=messages_summary, max_tokens=30, temperature=0)
         conversation_id = conversations_collection.insert_one(
             {"user": "local",
              "date": datetime.datetime.utcnow(),
-             "name": completion["choices"][0]["message"]["content"],
+             "name": conversation_title(question),
              "queries": [{"prompt": question, "response": reponse_full, "sources": source_log_docs}]}
         ).inserted_id
 
     # send data.type = "end" to indicate that the stream has ended as json
-    data = json.dumps({"type": "id", "id": str(conversation_id)})
+    data = orjson.dumps({"type": "id", "id": str(conversation_id)}).decode()
     yield f"data: {data}\n\n"
-    data = json.dumps({"type": "end"})
+    data = orjson.dumps({"type": "end"}).decode()
     yield f"data: {data}\n\n"
 
 
@@ -270,9 +463,7 @@ def stream():
     data = request.get_json()
     # get parameter from url question
     question = data["question"]
-    history = data["history"]
-    # history to json object from string
-    history = json.loads(history)
+    history = parse_history(data["history"])
     conversation_id = data["conversation_id"]
 
     # check if active_docs is set
@@ -289,25 +480,22 @@ def stream():
         vectorstore = get_vectorstore({"active_docs": data["active_docs"]})
     else:
         vectorstore = ""
-    docsearch = get_docsearch(vectorstore, embeddings_key)
+    docsearch = get_docsearch(vectorstore)
+    query_vector = get_embeddings(embeddings_key).embed_query(question)
 
     # question = "Hi"
     return Response(
-        complete_stream(question, docsearch,
+        complete_stream(question, docsearch, query_vector,
                         chat_history=history, api_key=api_key,
                         conversation_id=conversation_id), mimetype="text/event-stream"
     )
 
 
-def is_azure_configured():
-    return settings.OPENAI_API_BASE and settings.OPENAI_API_VERSION and settings.AZURE_DEPLOYMENT_NAME
-
-
 @app.route("/api/answer", methods=["POST"])
 def api_answer():
     data = request.get_json()
     question = data["question"]
-    history = data["history"]
+    history = parse_history(data["history"])
     if "conversation_id" not in data:
         conversation_id = None
     else:
@@ -328,36 +516,29 @@ def api_answer():
         vectorstore = get_vectorstore(data)
         # loading the index and the store and the prompt template
         # Note if you have used other embeddings than OpenAI, you need to change the embeddings
-        docsearch = get_docsearch(vectorstore, embeddings_key)
+        docsearch = get_docsearch(vectorstore)
+        # embed and search once, the chains get the documents found for it
+        query_vector = get_embeddings(embeddings_key).embed_query(question)
+        # the plain QA chain answers from 3 documents, the conversational chains and the sources use 2
+        docs_qa = docsearch.similarity_search_by_vector(query_vector, k=3)
+        docs = docs_qa[:2]
 
-        q_prompt = PromptTemplate(
-            input_variables=["context", "question"], template=template_quest, template_format="jinja2"
-        )
         if settings.LLM_NAME == "openai_chat":
-            if is_azure_configured():
-                logger.debug("in Azure")
-                llm = AzureChatOpenAI(
-                    openai_api_key=api_key,
-                    openai_api_base=settings.OPENAI_API_BASE,
-                    openai_api_version=settings.OPENAI_API_VERSION,
-                    deployment_name=settings.AZURE_DEPLOYMENT_NAME,
-                )
-            else:
-                logger.debug("plain OpenAI")
-                llm = ChatOpenAI(openai_api_key=api_key, model_name=gpt_model)  # optional parameter: model_name="gpt-4"
-            messages_combine = [SystemMessagePromptTemplate.from_template(chat_combine_template)]
+            llm = chat_llm if chat_llm is not None else create_chat_llm(api_key)
+            messages_combine = [system_combine_prompt]
             if history:
                 tokens_current_history = 0
-                # count tokens in history
-                history.reverse()
-                for i in history:
+                # count tokens in history, newest first, until the budget is used up
+                for i in reversed(history):
                     if "prompt" in i and "response" in i:
-                        tokens_batch = llm.get_num_tokens(i["prompt"]) + llm.get_num_tokens(i["response"])
-                        if tokens_current_history + tokens_batch < settings.TOKENS_MAX_HISTORY:
-                            tokens_current_history += tokens_batch
-                            messages_combine.append(HumanMessagePromptTemplate.from_template(i["prompt"]))
-                            messages_combine.append(AIMessagePromptTemplate.from_template(i["response"]))
-            messages_combine.append(HumanMessagePromptTemplate.from_template("{question}"))
+                        tokens_batch = count_tokens(i["prompt"]) + count_tokens(i["response"])
+                        if tokens_current_history + tokens_batch >= settings.TOKENS_MAX_HISTORY:
+                            break
+                        tokens_current_history += tokens_batch
+                        # history is user content, not a template
+                        messages_combine.append(HumanMessage(content=i["prompt"]))
+                        messages_combine.append(AIMessage(content=i["response"]))
+            messages_combine.append(human_question_prompt)
             p_chat_combine = ChatPromptTemplate.from_messages(messages_combine)
         elif settings.LLM_NAME == "openai":
             llm = OpenAI(openai_api_key=api_key, temperature=0)
@@ -372,7 +553,7 @@ def api_answer():
             question_generator = LLMChain(llm=llm, prompt=CONDENSE_QUESTION_PROMPT)
             doc_chain = load_qa_chain(llm, chain_type="map_reduce", combine_prompt=p_chat_combine)
             chain = ConversationalRetrievalChain(
-                retriever=docsearch.as_retriever(k=2),
+                retriever=StaticRetriever(docs=docs),
                 question_generator=question_generator,
                 combine_docs_chain=doc_chain,
             )
@@ -384,7 +565,7 @@ def api_answer():
             question_generator = LLMChain(llm=llm, prompt=CONDENSE_QUESTION_PROMPT)
             doc_chain = load_qa_chain(llm, chain_type="map_reduce", combine_prompt=p_chat_combine)
             chain = ConversationalRetrievalChain(
-                retriever=docsearch.as_retriever(k=2),
+                retriever=StaticRetriever(docs=docs),
                 question_generator=question_generator,
                 combine_docs_chain=doc_chain,
             )
@@ -397,7 +578,7 @@ def api_answer():
             qa_chain = load_qa_chain(
                 llm=llm, chain_type="map_reduce", combine_prompt=chat_combine_template, question_prompt=q_prompt
             )
-            chain = VectorDBQA(combine_documents_chain=qa_chain, vectorstore=docsearch, k=3)
+            chain = RetrievalQA(combine_documents_chain=qa_chain, retriever=StaticRetriever(docs=docs_qa))
             result = chain({"query": question})
 
         print(result)
@@ -411,9 +592,8 @@ def api_answer():
         except Exception:
             pass
 
-        sources = docsearch.similarity_search(question, k=2)
         sources_doc = []
-        for doc in sources:
+        for doc in docs:
             if doc.metadata:
                 sources_doc.append({'title': doc.metadata['title'], 'text': doc.page_content})
             else:
@@ -430,23 +610,10 @@ def api_answer():
 
         else:
             # create new conversation
-            # generate summary
-            messages_summary = [AIMessage(content="Summarise following conversation in no more than 3 " +
-                                                  "words, respond ONLY with the summary, use the same " +
-                                                  "language as the system \n\nUser: " + question + "\n\nAI: " +
-                                                  result["answer"]),
-                                HumanMessage(content="Summarise following conversation in no more than 3 words, " +
-                                                     "respond ONLY with the summary, use the same language as the " +
-                                                     "system")]
-
-
-            # completion = openai.ChatCompletion.create(model='gpt-3.5-turbo', engine=settings.AZURE_DEPLOYMENT_NAME,
-            #                                           messages=messages_summary, max_tokens=30, temperature=0)
-            completion = llm.predict_messages(messages_summary)
             conversation_id = conversations_collection.insert_one(
                 {"user": "local",
                  "date": datetime.datetime.utcnow(),
-                 "name": completion.content,
+                 "name": conversation_title(question),
                  "queries": [{"prompt": question, "response": result["answer"], "sources": result['sources']}]}
             ).inserted_id
 
@@ -457,7 +624,7 @@ def api_answer():
         #     "answer": "The answer is 42",
         #     "sources": ["https://en.wikipedia.org/wiki/42_(number)", "https://en.wikipedia.org/wiki/42_(number)"]
         # }
-        return result
+        return Response(orjson.dumps(result), mimetype="application/json")
     except Exception as e:
         # print whole traceback
         traceback.print_exc()
@@ -477,7 +644,11 @@ def check_docs():
     if os.path.exists(vectorstore) or data["docs"] == "default":
         return {"status": "exists"}
     else:
-        r = requests.get(base_path + vectorstore + "index.faiss")
+        # download the index and the store at the same time
+        future_faiss = http_executor.submit(http_session.get, base_path + vectorstore + "index.faiss")
+        future_pkl = http_executor.submit(http_session.get, base_path + vectorstore + "index.pkl")
+        r = future_faiss.result()
+        r_pkl = future_pkl.result()
 
         if r.status_code != 200:
             return {"status": "null"}
@@ -487,10 +658,8 @@ def check_docs():
             with open(vectorstore + "index.faiss", "wb") as f:
                 f.write(r.content)
 
-            # download the store
-            r = requests.get(base_path + vectorstore + "index.pkl")
             with open(vectorstore + "index.pkl", "wb") as f:
-                f.write(r.content)
+                f.write(r_pkl.content)
 
         return {"status": "loaded"}
 
@@ -507,7 +676,7 @@ def api_feedback():
     print("Answer: " + answer)
     print("Feedback: " + feedback)
     print("-" * 5)
-    response = requests.post(
+    response = http_session.post(
         url="https://86x89umx77.execute-api.eu-west-2.amazonaws.com/docsgpt-feedback",
         headers={
             "Content-Type": "application/json; charset=utf-8",
@@ -521,7 +690,8 @@ def api_feedback():
 def combined_json():
     user = "local"
     """Provide json file with combined available indexes."""
-    # get json from https://d3dg1063dc54p9.cloudfront.net/combined.json
+    # get json from https://d3dg1063dc54p9.cloudfront.net/combined.json while reading mongo
+    future_remote = http_executor.submit(http_session.get, "https://d3dg1063dc54p9.cloudfront.net/combined.json")
 
     data = [
         {
@@ -553,7 +723,7 @@ def combined_json():
             }
         )
 
-    data_remote = requests.get("https://d3dg1063dc54p9.cloudfront.net/combined.json").json()
+    data_remote = future_remote.result().json()
     for index in data_remote:
         index["location"] = "remote"
         data.append(index)
@@ -561,6 +731,26 @@ def combined_json():
     return jsonify(data)
 
 
+def save_upload(file, path):
+    """Save an uploaded file, with an in-kernel copy when werkzeug already spooled it to disk."""
+    with open(path, "wb") as dst:
+        # uploads under 500KB stay in memory in a SpooledTemporaryFile, calling fileno() on it
+        # would first write them to disk, so only large (rolled over) uploads use sendfile
+        if getattr(file.stream, "_rolled", True):
+            try:
+                src_fd = file.stream.fileno()
+                # sendfile reads from the current position of the stream
+                while os.sendfile(dst.fileno(), src_fd, None, 1 << 30):
+                    pass
+                return
+            except (AttributeError, OSError):
+                # no file descriptor, or sendfile can't write to a regular file on this platform
+                file.stream.seek(0)
+                dst.seek(0)
+                dst.truncate()
+        shutil.copyfileobj(file.stream, dst, length=1 << 20)
+
+
 @app.route("/api/upload", methods=["POST"])
 def upload_file():
     """Upload a file to get vectorized and indexed."""
@@ -586,7 +776,7 @@ def upload_file():
         if not os.path.exists(save_dir):
             os.makedirs(save_dir)
 
-        file.save(os.path.join(save_dir, filename))
+        save_upload(file, os.path.join(save_dir, filename))
         task = ingest.delay("temp", [".rst", ".md", ".pdf", ".txt"], job_name, filename, user)
         # task id
         task_id = task.id
@@ -631,8 +821,19 @@ def upload_index_files():
     save_dir = os.path.join("indexes", user, job_name)
     if not os.path.exists(save_dir):
         os.makedirs(save_dir)
-    file_faiss.save(os.path.join(save_dir, "index.faiss"))
-    file_pkl.save(os.path.join(save_dir, "index.pkl"))
+    # cached stores may have the current index.faiss memory-mapped, so never rewrite it in place:
+    # write new files next to it and swap them in with os.replace
+    tmp_paths = []
+    for file, filename in ((file_faiss, "index.faiss"), (file_pkl, "index.pkl")):
+        fd, tmp_path = tempfile.mkstemp(dir=save_dir, prefix=filename + ".")
+        os.close(fd)
+        save_upload(file, tmp_path)
+        tmp_paths.append((tmp_path, os.path.join(save_dir, filename)))
+    invalidate_docsearch_cache(save_dir)
+    for tmp_path, path in tmp_paths:
+        os.replace(tmp_path, path)
+    # a request between the two invalidations may have cached the old files again
+    invalidate_docsearch_cache(save_dir)
     # create entry in vectors_collection
     vectors_collection.insert_one(
         {
@@ -660,8 +861,6 @@ def download_file():
 @app.route("/api/delete_old", methods=["get"])
 def delete_old():
     """Delete old indexes."""
-    import shutil
-
     path = request.args.get("path")
     dirs = path.split("/")
     dirs_clean = []
@@ -676,13 +875,14 @@ def delete_old():
         shutil.rmtree(path_clean)
     except FileNotFoundError:
         pass
+    invalidate_docsearch_cache(path_clean)
     return {"status": "ok"}
 
 
 @app.route("/api/get_conversations", methods=["get"])
 def get_conversations():
     # provides a list of conversations
-    conversations = conversations_collection.find().sort("date", -1)
+    conversations = conversations_collection.find({}, {"name": 1}).sort("date", -1).limit(CONVERSATIONS_LIST_LIMIT)
     list_conversations = []
     for conversation in conversations:
         list_conversations.append({"id": str(conversation["_id"]), "name": conversation["name"]})
@@ -695,7 +895,9 @@ def get_conversations():
 def get_single_conversation():
     # provides data for a conversation
     conversation_id = request.args.get("id")
-    conversation = conversations_collection.find_one({"_id": ObjectId(conversation_id)})
+    conversation = conversations_collection.find_one(
+        {"_id": ObjectId(conversation_id)}, {"queries": {"$slice": -CONVERSATION_QUERIES_LIMIT}}
+    )
     return jsonify(conversation['queries'])
 
 @app.route("/api/delete_conversation", methods=["POST"])
@@ -723,4 +925,5 @@ def after_request(response):
 
 
 if __name__ == "__main__":
+    create_indexes()
     app.run(debug=True, port=7091)
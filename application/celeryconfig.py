@@ -3,6 +3,11 @@ import os
 broker_url = os.getenv("CELERY_BROKER_URL")
 result_backend = os.getenv("CELERY_RESULT_BACKEND")
 
-task_serializer = 'json'
-result_serializer = 'json'
-accept_content = ['json']
+task_serializer = 'msgpack'
+result_serializer = 'msgpack'
+# json is still accepted for tasks queued before the switch
+accept_content = ['msgpack', 'json']
+result_compression = 'gzip'
+
+# ingest tasks run for minutes, don't let a worker reserve more than the one it is running
+worker_prefetch_multiplier = 1
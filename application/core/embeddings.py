@@ -0,0 +1,34 @@
+from langchain.embeddings.base import Embeddings
+
+LOCAL_EMBEDDINGS_PREFIXES = ("onnx_", "model2vec_")
+
+
+class SentenceTransformerEmbeddings(Embeddings):
+    """Embeddings computed in-process with a sentence-transformers model (ONNX Runtime or Model2Vec)."""
+
+    def __init__(self, model):
+        self.model = model
+
+    def embed_documents(self, texts):
+        return self.model.encode(texts, normalize_embeddings=True).tolist()
+
+    def embed_query(self, text):
+        return self.model.encode(text, normalize_embeddings=True).tolist()
+
+
+def is_local_embeddings(embeddings_name):
+    return embeddings_name.startswith(LOCAL_EMBEDDINGS_PREFIXES)
+
+
+def get_local_embeddings(embeddings_name):
+    # sentence-transformers is only needed for the local embeddings
+    from sentence_transformers import SentenceTransformer
+
+    if embeddings_name.startswith("onnx_"):
+        model = SentenceTransformer(embeddings_name[len("onnx_"):], backend="onnx",
+                                    model_kwargs={"provider": "CPUExecutionProvider"})
+    else:
+        from sentence_transformers.models import StaticEmbedding
+
+        model = SentenceTransformer(modules=[StaticEmbedding.from_model2vec(embeddings_name[len("model2vec_"):])])
+    return SentenceTransformerEmbeddings(model)
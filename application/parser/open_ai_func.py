@@ -1,10 +1,16 @@
+import math
 import os
 
+import faiss
+import numpy as np
 import tiktoken
 from langchain.embeddings import OpenAIEmbeddings
 from langchain.vectorstores import FAISS
 from retry import retry
 
+from application.core.embeddings import get_local_embeddings, is_local_embeddings
+from application.core.settings import settings
+
 
 # from langchain.embeddings import HuggingFaceEmbeddings
 # from langchain.embeddings import HuggingFaceInstructEmbeddings
@@ -19,6 +25,30 @@ def num_tokens_from_string(string: str, encoding_name: str) -> int:
     return num_tokens, total_price
 
 
+# below this many vectors a flat index is both exact and fast enough
+IVFPQ_MIN_VECTORS = 10000
+IVFPQ_MAX_LISTS = 4096
+IVFPQ_SUBQUANTIZERS = 64
+# faiss k-means wants at least 39 training points per centroid
+IVF_MIN_POINTS_PER_LIST = 39
+
+
+def compress_index(store):
+    # Replace the flat index of a large store with a trained IVF-PQ index.
+    # Vectors keep their positions, so index_to_docstore_id stays valid.
+    index = store.index
+    n, d = index.ntotal, index.d
+    if n < IVFPQ_MIN_VECTORS or d % IVFPQ_SUBQUANTIZERS != 0:
+        return store
+    vectors = np.ascontiguousarray(index.reconstruct_n(0, n), dtype=np.float32)
+    nlist = min(IVFPQ_MAX_LISTS, int(4 * math.sqrt(n)), n // IVF_MIN_POINTS_PER_LIST)
+    ivfpq = faiss.index_factory(d, f"IVF{nlist},PQ{IVFPQ_SUBQUANTIZERS}")
+    ivfpq.train(vectors)
+    ivfpq.add(vectors)
+    store.index = ivfpq
+    return store
+
+
 @retry(tries=10, delay=60)
 def store_add_texts_with_retry(store, i):
     store.add_texts([i.page_content], metadatas=[i.metadata])
@@ -37,7 +67,12 @@ def call_openai_api(docs, folder_name, task_status):
     docs.pop(0)
     c1 = 0
 
-    store = FAISS.from_documents(docs_test, OpenAIEmbeddings(openai_api_key=os.getenv("EMBEDDINGS_KEY")))
+    # the index has to be built with the embeddings the app queries it with
+    if is_local_embeddings(settings.EMBEDDINGS_NAME):
+        embeddings = get_local_embeddings(settings.EMBEDDINGS_NAME)
+    else:
+        embeddings = OpenAIEmbeddings(openai_api_key=os.getenv("EMBEDDINGS_KEY"))
+    store = FAISS.from_documents(docs_test, embeddings)
 
     # Uncomment for MPNet embeddings
     # model_name = "sentence-transformers/all-mpnet-base-v2"
@@ -57,6 +92,7 @@ def call_openai_api(docs, folder_name, task_status):
             store.save_local(f"{folder_name}")
             break
         c1 += 1
+    compress_index(store)
     store.save_local(f"{folder_name}")
 
 
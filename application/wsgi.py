@@ -1,4 +1,6 @@
-from application.app import app
+from application.app import app, create_indexes
+
+create_indexes()
 
 if __name__ == "__main__":
     app.run(debug=True, port=7091)
@@ -121,7 +121,7 @@ export function fetchAnswerSteaming(
       api_key: apiKey,
       embeddings_key: apiKey,
       active_docs: docPath,
-      history: JSON.stringify(history),
+      history: history,
       conversation_id: conversationId,
     };
 
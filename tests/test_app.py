@@ -1,5 +1,23 @@
-from application.app import get_vectorstore, is_azure_configured
+from application.app import (
+    conversation_title,
+    get_vectorstore,
+    is_azure_configured,
+    docsearch_cache,
+    get_docsearch,
+    invalidate_docsearch_cache,
+    parse_history,
+    save_upload,
+    MissingEmbeddings,
+)
+import faiss
+import numpy as np
+from langchain import FAISS
+from langchain.docstore.in_memory import InMemoryDocstore
+from langchain.schema import Document
 import os
+import pytest
+import tempfile
+from werkzeug.datastructures import FileStorage
 
 
 # Test cases for get_vectorstore function
@@ -30,3 +48,87 @@ def test_complex_active_docs():
 
 def test_is_azure_configured():
     assert not is_azure_configured()
+
+
+def test_invalidate_docsearch_cache():
+    docsearch_cache.clear()
+    docsearch_cache[(os.path.join("application", "indexes", "local", "a"), "emb")] = "a"
+    docsearch_cache[(os.path.join("application", "indexes", "local", "b"), "emb")] = "b"
+    invalidate_docsearch_cache("indexes/local/a")
+    assert list(docsearch_cache.values()) == ["b"]
+    docsearch_cache.clear()
+
+
+def make_docsearch():
+    index = faiss.IndexFlatL2(2)
+    index.add(np.array([[0, 0], [10, 10]], dtype=np.float32))
+    docstore = InMemoryDocstore({"a": Document(page_content="a"), "b": Document(page_content="b")})
+    return FAISS(MissingEmbeddings().embed_query, index, docstore, {0: "a", 1: "b"})
+
+
+def test_get_docsearch_reloads_replaced_files(tmp_path):
+    docsearch_cache.clear()
+    store_dir = tmp_path / "store"
+    make_docsearch().save_local(str(store_dir))
+    docsearch = get_docsearch(str(store_dir))
+    assert get_docsearch(str(store_dir)) is docsearch
+    # another worker uploads the index again, replacing the files
+    make_docsearch().save_local(str(tmp_path / "new"))
+    for filename in ("index.faiss", "index.pkl"):
+        os.replace(tmp_path / "new" / filename, store_dir / filename)
+    assert get_docsearch(str(store_dir)) is not docsearch
+    # and deletes it
+    (store_dir / "index.faiss").unlink()
+    with pytest.raises(OSError):
+        get_docsearch(str(store_dir))
+    assert not docsearch_cache
+    docsearch_cache.clear()
+
+
+def test_parse_history():
+    history = [{"prompt": "Hi", "response": "Hello"}]
+    assert parse_history(history) == history
+    assert parse_history('[{"prompt": "Hi", "response": "Hello"}]') == history
+    assert parse_history("") == []
+    assert parse_history(None) == []
+
+
+def test_conversation_title():
+    assert conversation_title("How do I  install\nDocsGPT locally?") == "How do I"
+    assert conversation_title("   ") == "New chat"
+
+
+def spooled_upload(data, max_size):
+    stream = tempfile.SpooledTemporaryFile(max_size=max_size)
+    stream.write(data)
+    stream.seek(0)
+    return FileStorage(stream=stream, filename="upload.bin")
+
+
+def test_save_upload_in_memory(tmp_path, monkeypatch):
+    data = os.urandom(1000)
+    file = spooled_upload(data, max_size=1 << 20)
+    sendfile_calls = []
+    monkeypatch.setattr(os, "sendfile", lambda *args: sendfile_calls.append(args))
+    save_upload(file, tmp_path / "upload.bin")
+    assert (tmp_path / "upload.bin").read_bytes() == data
+    # the upload stays in memory and is copied without sendfile
+    assert not file.stream._rolled
+    assert sendfile_calls == []
+
+
+def test_save_upload_on_disk(tmp_path, monkeypatch):
+    data = os.urandom(3 << 20)
+    file = spooled_upload(data, max_size=1 << 20)
+    assert file.stream._rolled
+    sendfile = os.sendfile
+    sendfile_calls = []
+
+    def counting_sendfile(*args):
+        sendfile_calls.append(args)
+        return sendfile(*args)
+
+    monkeypatch.setattr(os, "sendfile", counting_sendfile)
+    save_upload(file, tmp_path / "upload.bin")
+    assert (tmp_path / "upload.bin").read_bytes() == data
+    assert sendfile_calls
@@ -0,0 +1,36 @@
+from application.parser.open_ai_func import compress_index, IVFPQ_MIN_VECTORS
+import faiss
+import numpy as np
+from langchain import FAISS
+from langchain.docstore.in_memory import InMemoryDocstore
+from langchain.schema import Document
+
+
+def make_store(n, d=64):
+    vectors = np.random.default_rng(0).random((n, d), dtype=np.float32)
+    index = faiss.IndexFlatL2(d)
+    index.add(vectors)
+    ids = {i: f"doc-{i}" for i in range(n)}
+    docstore = InMemoryDocstore({doc_id: Document(page_content=doc_id) for doc_id in ids.values()})
+    return FAISS(lambda text: vectors[0], index, docstore, ids), vectors
+
+
+def test_compress_index_keeps_small_stores_flat():
+    store, _ = make_store(100)
+    index = store.index
+    assert compress_index(store).index is index
+
+
+def test_compress_index_keeps_docstore_ids():
+    store, vectors = make_store(IVFPQ_MIN_VECTORS)
+    ids = dict(store.index_to_docstore_id)
+    compress_index(store)
+    assert faiss.try_extract_index_ivf(store.index) is not None
+    assert store.index.ntotal == IVFPQ_MIN_VECTORS
+    assert store.index_to_docstore_id == ids
+    # vectors keep their positions, so a stored vector still finds its own document
+    faiss.try_extract_index_ivf(store.index).nprobe = 16
+    _, indices = store.index.search(vectors[:10], 5)
+    for i, row in enumerate(indices):
+        assert i in row
+        assert store.docstore.search(store.index_to_docstore_id[i]).page_content == f"doc-{i}"